@@ -59,6 +59,12 @@ group.add_argument('--nosettings', action='store_true',
                    help='Do not retrieve Group Settings.')
 group.add_argument('--datestamp', action='store_true',
                    help='Datestamp all CSVs.')
+group.add_argument('--workers', nargs=1, type=int, default=[32],
+                   help=('Number of member requests to run concurrently '
+                         '(default: 32).'))
+group.add_argument('--batch_workers', nargs=1, type=int, default=[4],
+                   help=('Number of settings batches to run concurrently '
+                         '(default: 4).'))
 
 args = parser.parse_args()
 
@@ -77,7 +83,8 @@ logger.addHandler(stdout_logger)
 errors = 0
 
 # Start backup process.
-ggbackup = GGBackup(args.domain)
+ggbackup = GGBackup(args.domain, max_workers=args.workers[0],
+                    batch_workers=args.batch_workers[0])
 
 # Authenticate
 if args.first or args.save or args.setup:
@@ -133,11 +140,16 @@ except Exception as e:
 
 ggwriter = GGWriter(os.path.join(args.target[0], args.domain),
                     ggbackup.groups,
-                    datestamp=args.datestamp)
+                    datestamp=args.datestamp,
+                    members=ggbackup.members)
 
 try:
-    ggwriter.write_members()
-    logger.info('Wrote all group membership CSVs.')
+    skipped = ggwriter.write_members()
+    if skipped:
+        logger.error('Skipped membership CSVs for %s groups.', skipped)
+        errors += skipped
+    else:
+        logger.info('Wrote all group membership CSVs.')
 except Exception as e:
     logger.error('Error writing group membership: %s', e)
     errors += 1
@@ -149,4 +161,5 @@ except Exception as e:
     logger.error('Error writing group settings: %s', e)
     errors += 1
 
-exit(errors)
+# Exit statuses wrap at 256, so cap the count to keep failures non-zero.
+exit(min(errors, 255))
@@ -17,60 +17,116 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import json
 import logging
+import os
 import httplib2
-import webbrowser
+import threading
+import time
 
-from math import ceil
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
-from builtins import input
-
-from apiclient import discovery
-from oauth2client import client
-from oauth2client.file import Storage
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 
 logger = logging.getLogger(__name__)
 
+SCOPES = [
+    'https://www.googleapis.com/auth/admin.directory.group.readonly',
+    'https://www.googleapis.com/auth/admin.directory.group.member.readonly',
+    'https://www.googleapis.com/auth/apps.groups.settings'
+]
+
+# Socket timeout, in seconds, for API connections.
+HTTP_TIMEOUT = 30
+
+# Member fields kept in the backup; all others are left out of responses.
+MEMBER_FIELDS = ('kind', 'id', 'email', 'role', 'type', 'status', 'etag')
+MEMBER_LIST_FIELDS = 'nextPageToken,members(%s)' % ','.join(MEMBER_FIELDS)
+
+# Batch size limits. Google caps batches at 1000 requests; batches are halved
+# down to MIN_BATCH_SIZE when the API starts rate limiting.
+BATCH_SIZE = 1000
+MIN_BATCH_SIZE = 50
+
+# Settings batches each carry up to BATCH_SIZE requests, so only a few run
+# at once.
+BATCH_WORKERS = 4
+
+# Retries for rate limited or failed requests, with exponential backoff.
+MAX_RETRIES = 5
+
+
+def is_rate_limited(exception):
+    """Return whether an API error was caused by rate limiting."""
+    resp = getattr(exception, 'resp', None)
+    status = getattr(resp, 'status', None)
+    if status == 429:
+        return True
+    content = getattr(exception, 'content', None) or b''
+    return status == 403 and b'ratelimitexceeded' in content.lower()
+
+
+def gzip_user_agent(http, product):
+    """Prefix product to the user agent of every request on http.
+
+    Google only compresses responses for user agents containing "(gzip)".
+    Requests built by the API client already carry it; the outer request
+    of a batch does not, so it is added only where missing.
+    """
+    request_orig = http.request
+
+    def request(uri, method='GET', body=None, headers=None, *args,
+                **kwargs):
+        headers = dict(headers or {})
+        user_agent = headers.get('user-agent', '')
+        if '(gzip)' not in user_agent:
+            user_agent = (user_agent + ' (gzip)').strip()
+        headers['user-agent'] = '%s %s' % (product, user_agent)
+        return request_orig(uri, method, body, headers, *args, **kwargs)
+
+    http.request = request
+    return http
+
 
 class GGBackup(object):
     """Object to handle GGBackup operations."""
 
-    def __init__(self, domain):
+    def __init__(self, domain, max_workers=32, batch_workers=BATCH_WORKERS):
         """Init with target domain, set initial values."""
         super(GGBackup, self).__init__()
         self.domain = domain
+        self.max_workers = max_workers
+        self.batch_workers = batch_workers
         self.http_auth = None
         self.credentials = None
         self.service = None
         self.gsetservice = None
         self.groups = {}
-        self._group_batch = None
+        self.members = {}
+        self._group_batches = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
 
     def first_auth(self, client_secrets):
         """Authenticate with Google API."""
-        flow = client.flow_from_clientsecrets(
-            client_secrets,
-            scope=[
-                'https://www.googleapis.com/auth/admin.directory.group.readonly',  # noqa
-                'https://www.googleapis.com/auth/admin.directory.group.member.readonly',  # noqa
-                'https://www.googleapis.com/auth/apps.groups.settings'
-            ],
-            redirect_uri='urn:ietf:wg:oauth:2.0:oob')
-
-        logger.debug('Generating authorization URL.')
-        auth_uri = flow.step1_get_authorize_url()
-        webbrowser.open(auth_uri)
+        # Only needed for the one-time setup; pulls in requests/oauthlib.
+        from google_auth_oauthlib.flow import InstalledAppFlow
 
-        auth_code = input('Enter the auth code: ')
+        flow = InstalledAppFlow.from_client_secrets_file(client_secrets,
+                                                         scopes=SCOPES)
 
-        logger.debug('Generating credentials.')
-        self.credentials = flow.step2_exchange(auth_code)
+        # The browser redirects back to a local server on a free port, so
+        # the authorization code never has to be pasted in by hand.
+        logger.debug('Waiting for authorization in the browser.')
+        self.credentials = flow.run_local_server(port=0)
 
     def check_credentials(self):
         """Check if credentials have been gathered."""
         if self.credentials is None:
             raise Exception('Credentials not found.')
-        if self.credentials.invalid:
+        if not (self.credentials.valid or self.credentials.refresh_token):
             raise Exception('Credentials are invalid.')
 
     def check_auth(self):
@@ -85,53 +141,120 @@ class GGBackup(object):
     def save(self, cred_file):
         """Save credentials to an external file."""
         self.check_credentials()
-        storage = Storage(cred_file)
-        storage.put(self.credentials)
+        info = {
+            'token': self.credentials.token,
+            'refresh_token': self.credentials.refresh_token,
+            'token_uri': self.credentials.token_uri,
+            'client_id': self.credentials.client_id,
+            'client_secret': self.credentials.client_secret,
+            'scopes': self.credentials.scopes,
+        }
+        # The file holds a refresh token; keep it readable by the owner only.
+        fd = os.open(cred_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(info, f)
         logger.info('Saved credentials to %s', cred_file)
 
     def load(self, cred_file):
         """Load pre-saved credentials."""
-        storage = Storage(cred_file)
-        self.credentials = storage.get()
+        self.credentials = Credentials.from_authorized_user_file(
+            cred_file, scopes=SCOPES)
 
     def auth(self):
         """Authenticate with the API and create the service."""
+        # The discovery client is slow to import; defer it until needed.
+        from apiclient import discovery
+        from .ggmodel import FastJsonModel
+
         self.check_credentials()
-        self.http_auth = self.credentials.authorize(httplib2.Http())
+        self.http_auth = self.build_http()
+        # Let the authenticating thread reuse this connection.
+        self._local.http = self.http_auth
+        model = FastJsonModel()
         self.service = discovery.build('admin', 'directory_v1',
                                        http=self.http_auth,
+                                       model=model,
                                        cache_discovery=False)
         self.gsetservice = discovery.build('groupssettings', 'v1',
                                            http=self.http_auth,
+                                           model=model,
                                            cache_discovery=False)
 
+    def build_http(self):
+        """Return a new authorized, keep-alive Http object."""
+        from . import __version__
+
+        # The user agent goes on the inner transport so AuthorizedHttp can
+        # still retry with its own arguments after refreshing a token.
+        http = gzip_user_agent(httplib2.Http(timeout=HTTP_TIMEOUT),
+                               'ggbackup/%s' % __version__)
+        return AuthorizedHttp(self.credentials, http=http)
+
+    def thread_http(self):
+        """Return an authorized Http object for the current thread.
+
+        httplib2 is not thread-safe, so each worker thread gets its own and
+        keeps its connection alive across batches.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self.build_http()
+            self._local.http = http
+        return http
+
+    def execute(self, request):
+        """Execute a request with the current thread's Http object."""
+        return request.execute(http=self.thread_http())
+
+    def execute_batches(self, executor, batchreqs, workers):
+        """Execute batch requests on the executor, workers at a time.
+
+        batchreqs holds (request IDs, batch request) pairs. Returns the
+        request IDs of batches the API rejected outright for rate limiting.
+        """
+        from apiclient.errors import HttpError
+
+        def execute(item):
+            request_ids, batchreq = item
+            try:
+                self.execute(batchreq)
+            except HttpError as e:
+                if not is_rate_limited(e):
+                    raise
+                return request_ids
+            return []
+
+        logger.debug('Executing %s batches.', len(batchreqs))
+        limited = []
+        for wave in self.batch(batchreqs, size=workers):
+            for request_ids in executor.map(execute, wave):
+                limited += request_ids
+        return limited
+
     def get_groups(self):
         """Retrieve google groups."""
         self.check_auth()
-        request = self.service.groups().list(domain=self.domain)
+        request = self.service.groups().list(domain=self.domain,
+                                             maxResults=200,
+                                             fields='nextPageToken,groups')
         while request is not None:
-            groups = request.execute()
+            groups = self.execute(request)
+            # Keys are normalized once here and reused as batch request IDs.
             for group in groups['groups']:
                 self.groups[group['email'].lower()] = group
             request = self.service.groups().list_next(request, groups)
+        # Batches are cached from the group keys; rebuild them on next use.
+        self._group_batches = None
         logger.info('Retrieved %s groups.', len(self.groups))
 
-    def batch(self, items):
-        """Return a list of lists that contain 1000 items or less."""
-        count = ceil(float(len(items)) / 1000.)
-        batches = []
-        i = 0
-        while i < count:
-            low = i * 1000
-            high = (i + 1) * 1000
-            batches.append(items[low:high])
-            i += 1
-        return batches
+    def batch(self, items, size=BATCH_SIZE):
+        """Return a list of lists that contain size items or less."""
+        return [items[i:i + size] for i in range(0, len(items), size)]
 
     @property
     def group_batches(self):
         """Return batches of groups."""
-        if self._group_batch is None:
+        if self._group_batches is None:
             groups = list(self.groups.keys())
             self._group_batches = self.batch(groups)
         return self._group_batches
@@ -139,88 +262,117 @@ class GGBackup(object):
     def get_settings(self):
         """Retrieve all group settings."""
         self.check_auth()
+        debug = logger.isEnabledFor(logging.DEBUG)
+        get_request = self.gsetservice.groups().get
 
         def add_settings(request_id, response, exception):
             if exception is not None:
+                if is_rate_limited(exception):
+                    with self._lock:
+                        limited.append(request_id)
+                    return
                 logger.warning(
                     'Exception encountered while gathering settings: %s',
                     exception)
                 return
-            logger.debug('Settings for group %s retrieved.',
-                         response['email'])
-            email = self.groups[response['email'].lower()]
-            email.update(response)
-
-        for batch in self.group_batches:
-            batchreq = self.gsetservice.new_batch_http_request(
-                callback=add_settings)
-            for group in batch:
-                batchreq.add(self.gsetservice.groups().get(groupUniqueId=group,
-                                                           alt='json'))
-                logger.debug('Added group %s to batch.', group)
-            logger.debug('Executing batch.')
-            batchreq.execute()
+            if debug:
+                logger.debug('Settings for group %s retrieved.', request_id)
+            email = self.groups[request_id]
+            with self._lock:
+                email.update(response)
+
+        # Groups that hit the rate limit, alone or because their whole batch
+        # was rejected, are retried after a backoff, with
+        # both the batch size and the number of concurrent batches halved
+        # each round. The pool is kept across rounds so its threads keep
+        # their connections.
+        size = BATCH_SIZE
+        workers = self.batch_workers
+        batches = self.group_batches
+        attempt = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while batches:
+                limited = []
+                batchreqs = []
+                for batch in batches:
+                    batchreq = self.gsetservice.new_batch_http_request(
+                        callback=add_settings)
+                    add = batchreq.add
+                    for group in batch:
+                        add(get_request(groupUniqueId=group, alt='json'),
+                            request_id=group)
+                    logger.debug('Added %s groups to batch.', len(batch))
+                    batchreqs.append((batch, batchreq))
+
+                limited += self.execute_batches(executor, batchreqs, workers)
+
+                if not limited:
+                    break
+                if attempt == MAX_RETRIES:
+                    logger.warning('Rate limited retrieving settings for %s '
+                                   'groups; giving up.', len(limited))
+                    break
+                size = max(MIN_BATCH_SIZE, size // 2)
+                workers = max(1, workers // 2)
+                attempt += 1
+                logger.info('Rate limited on %s groups; retrying in batches '
+                            'of %s, %s at a time.', len(limited), size,
+                            workers)
+                time.sleep(2 ** attempt)
+                batches = self.batch(limited, size=size)
+
+    def member_pages(self, group):
+        """Yield each page of a group's members as it is retrieved."""
+        http = self.thread_http()
+        members = self.service.members()
+        request = members.list(groupKey=group, fields=MEMBER_LIST_FIELDS,
+                               alt='json')
+        while request is not None:
+            response = request.execute(http=http, num_retries=MAX_RETRIES)
+            yield response.get('members', [])
+            request = members.list_next(request, response)
+
+    def iter_members(self):
+        """Yield (group, member) pairs, holding one page in memory at a time.
+
+        Unlike get_members, groups are paged one after another and nothing
+        is stored on the object, so callers can stream members to disk.
+        If a page cannot be retrieved the HttpError is raised; members of
+        that group yielded so far are incomplete and should be discarded.
+        """
+        from apiclient.errors import HttpError
+
+        self.check_auth()
+        for group in list(self.groups):
+            try:
+                for page in self.member_pages(group):
+                    for member in page:
+                        yield group, member
+            except HttpError as e:
+                logger.error('Members of group %s are incomplete: %s',
+                             group, e)
+                raise
 
     def get_members(self):
         """Retrieve all group memberships."""
-        self.check_auth()
+        from apiclient.errors import HttpError
 
-        self._next_batch = []
+        self.check_auth()
 
-        def add_members(request_id, response, exception):
-            if exception is not None:
+        def fetch_members(group):
+            """Page through the members of a single group."""
+            try:
+                pages = list(self.member_pages(group))
+            except HttpError as e:
                 logger.warning(
                     'Exception encountered while gathering group members: %s',
-                    exception)
-                return
-            logger.debug('Group %s members retrieved: %s', request_id,
-                         len(response.get('members', [])))
-            email = self.groups[request_id]
-            if 'members' not in email:
-                email['members'] = []
-            email['members'] += response.get('members', [])
-
-            # Prepare next page request with a tuple in the format:
-            # (groupId, request)
-            if 'nextPageToken' in response:
-                self._next_batch.append(
-                    (request_id,
-                     self.service.members().list(
-                         groupKey=request_id,
-                         nextPage=response['nextPageToken'],
-                         alt='json')))
-
-        def run_next_batch():
-            """Process next pages for all batches."""
-            if len(self._next_batch) == 0:
-                logger.debug('No more pages to retrieve.')
+                    e)
                 return
-            logger.debug('Building next page batches.')
-            working_batch = self._next_batch
-            self._next_batch = []
-
-            batches = self.batch(working_batch)
-            for batch in batches:
-                batchreq = self.service.new_batch_http_request(
-                    callback=add_members)
-                for req in batch:
-                    batchreq.add(req[1], request_id=req[0])
-                    logger.debug('Building next page batch for group %s',
-                                 req[0])
-                logger.debug('Executing batch.')
-                batchreq.execute()
-
-            run_next_batch()
-
-        for batch in self.group_batches:
-            batchreq = self.service.new_batch_http_request(
-                callback=add_members)
-            for group in batch:
-                batchreq.add(self.service.members().list(groupKey=group,
-                                                         alt='json'),
-                             request_id=group.lower())
-                logger.debug('Added group %s to batch.', group)
-            logger.debug('Executing batch.')
-            batchreq.execute()
-
-        run_next_batch()
+            members = list(chain.from_iterable(pages))
+            logger.debug('Group %s members retrieved: %s', group,
+                         len(members))
+            with self._lock:
+                self.members[group] = members
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(fetch_members, list(self.groups)))
@@ -0,0 +1,40 @@
+# Copyright 2017 The Linde Group, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Google API Response Model."""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from apiclient.model import JsonModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJsonModel(JsonModel):
+    """Parse API responses with orjson when it is installed."""
+
+    def deserialize(self, content):
+        """Convert a response body into a Python object."""
+        if orjson is None:
+            return super(FastJsonModel, self).deserialize(content)
+        # JsonModel calls json.loads directly, so its unwrapping is mirrored
+        # here; tests/test_ggmodel.py checks the two stay in agreement.
+        body = orjson.loads(content)
+        if self._data_wrapper and isinstance(body, dict) and 'data' in body:
+            body = body['data']
+        return body
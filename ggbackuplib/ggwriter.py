@@ -22,7 +22,9 @@ import logging
 import os
 
 from datetime import date
-from six import itervalues
+from six import iteritems, itervalues
+
+from .ggbackup import MEMBER_FIELDS
 
 logger = logging.getLogger(__name__)
 
@@ -30,8 +32,12 @@ logger = logging.getLogger(__name__)
 class GGWriter(object):
     """Write Google Groups data from a GGBackup object."""
 
-    def __init__(self, path, groups, datestamp=False):
-        """Initialize and create the directory if needed."""
+    def __init__(self, path, groups, datestamp=False, members=None):
+        """Initialize and create the directory if needed.
+
+        members maps group keys to member lists. If it is not given, member
+        lists are read from each group's 'members' entry.
+        """
         super(GGWriter, self).__init__()
 
         if not os.path.exists(path):
@@ -41,6 +47,11 @@ class GGWriter(object):
 
         self.path = path
         self.groups = groups
+        if members is None:
+            members = dict((key, group['members'])
+                           for key, group in iteritems(groups)
+                           if 'members' in group)
+        self.members = members
         self.datestamp = datestamp
 
     def append_datestamp(self, filename):
@@ -50,8 +61,15 @@ class GGWriter(object):
         return root + datestamp + ext
 
     def write_members(self):
-        """Write the members CSV."""
-        for group in itervalues(self.groups):
+        """Write the members CSVs; return how many groups were skipped."""
+        skipped = 0
+        for key, group in iteritems(self.groups):
+            if key not in self.members:
+                logger.warning('No members retrieved for %s, skipping.',
+                               group['email'])
+                skipped += 1
+                continue
+
             filename = group['email'] + '-membership.csv'
             if self.datestamp:
                 filename = self.append_datestamp(filename)
@@ -60,11 +78,11 @@ class GGWriter(object):
             logger.debug('Writing %s...', path)
 
             with open(path, 'w') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=[
-                    'kind', 'id', 'email', 'role', 'type', 'status', 'etag'])
+                writer = csv.DictWriter(csvfile, fieldnames=MEMBER_FIELDS)
                 writer.writeheader()
-                for member in group['members']:
+                for member in self.members[key]:
                     writer.writerow(member)
+        return skipped
 
     def write_settings(self):
         """Write the settings."""
@@ -79,7 +97,7 @@ class GGWriter(object):
         fields = set()
         for group in itervalues(self.groups):
             fields |= set(group.keys())
-        fields.remove('members')
+        fields.discard('members')
         fields.remove('email')
 
         fields = list(fields)
@@ -87,13 +105,12 @@ class GGWriter(object):
         fields.insert(0, 'email')
 
         with open(path, 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fields)
+            writer = csv.DictWriter(csvfile, fieldnames=fields,
+                                    extrasaction='ignore')
             writer.writeheader()
             for group in itervalues(self.groups):
-                g = group.copy()
-                del g['members']
-
-                if 'aliases' in g:
-                    g['aliases'] = ','.join(g['aliases'])
+                if 'aliases' in group:
+                    group = group.copy()
+                    group['aliases'] = ','.join(group['aliases'])
 
-                writer.writerow(g)
+                writer.writerow(group)
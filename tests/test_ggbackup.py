@@ -0,0 +1,394 @@
+# Copyright 2017 The Linde Group, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""GGBackup tests."""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+import re
+import unittest
+
+import httplib2
+
+from apiclient.errors import HttpError
+
+from ggbackuplib import GGBackup
+from ggbackuplib import ggbackup
+from ggbackuplib.ggbackup import MAX_RETRIES, is_rate_limited
+
+
+def http_error(status, content=b''):
+    """Return an HttpError with the given status."""
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class FakeRequest(object):
+    """A request that returns or raises a canned result."""
+
+    def __init__(self, result, page=0):
+        """Store the result and page number."""
+        self.result = result
+        self.page = page
+
+    def execute(self, http=None, num_retries=0):
+        """Return or raise the canned result."""
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class FakeMembers(object):
+    """A members() resource serving canned pages per group."""
+
+    def __init__(self, pages):
+        """Map group keys to lists of page results."""
+        self.pages = pages
+
+    def list(self, groupKey, **kwargs):
+        """Return the first page request for a group."""
+        request = FakeRequest(self.pages[groupKey][0])
+        request.group = groupKey
+        return request
+
+    def list_next(self, request, response):
+        """Return the next page request, or None after the last page."""
+        page = request.page + 1
+        if page == len(self.pages[request.group]):
+            return None
+        next_request = FakeRequest(self.pages[request.group][page], page)
+        next_request.group = request.group
+        return next_request
+
+
+class FakeService(object):
+    """An Admin SDK service with a canned members() resource."""
+
+    def __init__(self, pages):
+        """Serve the given member pages."""
+        self._members = FakeMembers(pages)
+
+    def members(self):
+        """Return the members resource."""
+        return self._members
+
+
+def make_backup(groups, service=None, gsetservice=None):
+    """Return a GGBackup wired to fake services."""
+    backup = GGBackup('example.com')
+    backup.http_auth = object()
+    backup.service = service or object()
+    backup.gsetservice = gsetservice or object()
+    backup.thread_http = lambda: None
+    for group in groups:
+        backup.groups[group] = {'email': group}
+    return backup
+
+
+class MemberPagesTest(unittest.TestCase):
+    """Test member paging."""
+
+    pages = {
+        'a@example.com': [{'members': [{'id': '1'}], 'nextPageToken': 't'},
+                          {'members': [{'id': '2'}]}],
+        'b@example.com': [{}],
+    }
+
+    def test_member_pages_follows_list_next(self):
+        """Every page of a group is yielded in order."""
+        backup = make_backup(self.pages, FakeService(self.pages))
+        self.assertEqual(list(backup.member_pages('a@example.com')),
+                         [[{'id': '1'}], [{'id': '2'}]])
+        self.assertEqual(list(backup.member_pages('b@example.com')), [[]])
+
+    def test_iter_members(self):
+        """Members of every group are yielded with their group."""
+        backup = make_backup(self.pages, FakeService(self.pages))
+        self.assertEqual(list(backup.iter_members()),
+                         [('a@example.com', {'id': '1'}),
+                          ('a@example.com', {'id': '2'})])
+
+    def test_iter_members_raises_on_failed_page(self):
+        """A failed later page is raised, not swallowed."""
+        pages = {'a@example.com': [self.pages['a@example.com'][0],
+                                   http_error(500)]}
+        backup = make_backup(pages, FakeService(pages))
+        members = backup.iter_members()
+        self.assertEqual(next(members), ('a@example.com', {'id': '1'}))
+        self.assertRaises(HttpError, next, members)
+
+    def test_get_members(self):
+        """get_members stores each group's flattened pages."""
+        backup = make_backup(self.pages, FakeService(self.pages))
+        backup.get_members()
+        self.assertEqual(backup.members,
+                         {'a@example.com': [{'id': '1'}, {'id': '2'}],
+                          'b@example.com': []})
+
+
+class RateLimitTest(unittest.TestCase):
+    """Test rate limit detection."""
+
+    def test_too_many_requests(self):
+        """HTTP 429 is a rate limit."""
+        self.assertTrue(is_rate_limited(http_error(429)))
+
+    def test_rate_limit_exceeded(self):
+        """403s with a rate limit reason are rate limits."""
+        for reason in (b'rateLimitExceeded', b'userRateLimitExceeded'):
+            content = b'{"error": {"errors": [{"reason": "%s"}]}}' % reason
+            self.assertTrue(is_rate_limited(http_error(403, content)))
+
+    def test_forbidden(self):
+        """Other 403s are not rate limits."""
+        content = b'{"error": {"errors": [{"reason": "forbidden"}]}}'
+        self.assertFalse(is_rate_limited(http_error(403, content)))
+
+    def test_missing_content(self):
+        """A 403 without a body is not a rate limit."""
+        error = http_error(403)
+        error.content = None
+        self.assertFalse(is_rate_limited(error))
+
+    def test_other_exceptions(self):
+        """Errors without a response are not rate limits."""
+        self.assertFalse(is_rate_limited(ValueError('boom')))
+
+
+class FakeBatch(object):
+    """A batch request that runs its callback with canned outcomes."""
+
+    def __init__(self, service, callback):
+        """Store the owning service and callback."""
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        """Queue a request."""
+        self.requests.append(request_id)
+
+    def execute(self, http=None):
+        """Answer each request from the service's outcome function."""
+        self.service.batches.append(list(self.requests))
+        if self.service.rejected_batches:
+            self.service.rejected_batches -= 1
+            raise http_error(self.service.rejected_status)
+        for group in self.requests:
+            self.service.calls[group] = self.service.calls.get(group, 0) + 1
+            if self.service.limited(group, self.service.calls[group]):
+                self.callback(group, None, http_error(429))
+            else:
+                self.callback(group, {'email': group, 'setting': 'on'}, None)
+
+
+class FakeGroupsSettings(object):
+    """A Groups Settings service with scripted rate limiting."""
+
+    def __init__(self, limited):
+        """limited(group, call_number) says whether a call is limited."""
+        self.limited = limited
+        self.rejected_batches = 0
+        self.rejected_status = 429
+        self.batches = []
+        self.calls = {}
+
+    def groups(self):
+        """Return the groups resource."""
+        return self
+
+    def get(self, groupUniqueId, alt):
+        """Return a request placeholder."""
+        return groupUniqueId
+
+    def new_batch_http_request(self, callback):
+        """Return a new fake batch."""
+        return FakeBatch(self, callback)
+
+
+class GetSettingsTest(unittest.TestCase):
+    """Test retrying rate limited settings requests."""
+
+    groups = ['a@example.com', 'b@example.com', 'c@example.com']
+
+    def setUp(self):
+        """Record backoff sleeps instead of sleeping."""
+        self.sleeps = []
+        self.time = ggbackup.time
+        ggbackup.time = self
+
+    def tearDown(self):
+        """Restore the time module."""
+        ggbackup.time = self.time
+
+    def sleep(self, seconds):
+        """Record a backoff."""
+        self.sleeps.append(seconds)
+
+    def make_backup(self, limited):
+        """Return a backup whose settings and batching are recorded."""
+        service = FakeGroupsSettings(limited)
+        backup = make_backup(self.groups, gsetservice=service)
+        backup.sizes = []
+        backup.workers = []
+
+        batch = backup.batch
+        execute_batches = backup.execute_batches
+
+        def record_batch(items, size=ggbackup.BATCH_SIZE):
+            backup.sizes.append(size)
+            return batch(items, size=size)
+
+        def record_execute_batches(executor, batchreqs, workers):
+            backup.workers.append(workers)
+            return execute_batches(executor, batchreqs, workers)
+
+        backup.batch = record_batch
+        backup.execute_batches = record_execute_batches
+        return backup
+
+    def test_limited_groups_retried(self):
+        """Only limited groups are retried, in smaller, fewer batches."""
+        backup = self.make_backup(
+            lambda group, call: group == 'b@example.com' and call == 1)
+        backup.get_settings()
+
+        service = backup.gsetservice
+        self.assertEqual(service.calls, {'a@example.com': 1,
+                                         'b@example.com': 2,
+                                         'c@example.com': 1})
+        self.assertEqual(service.batches[-1], ['b@example.com'])
+        self.assertIn(ggbackup.BATCH_SIZE // 2, backup.sizes)
+        self.assertEqual(backup.workers, [backup.batch_workers,
+                                          backup.batch_workers // 2])
+        self.assertEqual(self.sleeps, [2])
+        for group in self.groups:
+            self.assertEqual(backup.groups[group]['setting'], 'on')
+
+    def test_rejected_batch_retried(self):
+        """A batch rejected as a whole is retried with backoff."""
+        backup = self.make_backup(lambda group, call: False)
+        backup.gsetservice.rejected_batches = 1
+        backup.get_settings()
+
+        service = backup.gsetservice
+        self.assertEqual(service.batches, [self.groups, self.groups])
+        self.assertEqual(backup.workers, [backup.batch_workers,
+                                          backup.batch_workers // 2])
+        self.assertEqual(self.sleeps, [2])
+        for group in self.groups:
+            self.assertEqual(backup.groups[group]['setting'], 'on')
+
+    def test_failed_batch_raised(self):
+        """A batch rejected for other reasons is not retried."""
+        backup = self.make_backup(lambda group, call: False)
+        backup.gsetservice.rejected_batches = 1
+        backup.gsetservice.rejected_status = 500
+        self.assertRaises(HttpError, backup.get_settings)
+        self.assertEqual(self.sleeps, [])
+
+    def test_gives_up_after_max_retries(self):
+        """Groups that stay limited are dropped after MAX_RETRIES."""
+        backup = self.make_backup(
+            lambda group, call: group == 'c@example.com')
+        backup.get_settings()
+
+        service = backup.gsetservice
+        self.assertEqual(service.calls['c@example.com'], MAX_RETRIES + 1)
+        self.assertEqual(service.calls['a@example.com'], 1)
+        self.assertEqual(len(self.sleeps), MAX_RETRIES)
+        self.assertEqual(backup.workers[-1], 1)
+        self.assertNotIn('setting', backup.groups['c@example.com'])
+        self.assertEqual(backup.groups['a@example.com']['setting'], 'on')
+
+
+class FakeHttp(object):
+    """An Http object that replays canned statuses and records headers."""
+
+    def __init__(self, statuses):
+        """Store the statuses to return, in order."""
+        self.statuses = list(statuses)
+        self.headers = []
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=5, connection_type=None):
+        """Return the next canned response."""
+        self.headers.append(headers)
+        return httplib2.Response({'status': self.statuses.pop(0)}), b'{}'
+
+
+class FakeHttplib2(object):
+    """Stand-in for the httplib2 module that hands out one FakeHttp."""
+
+    def __init__(self, http):
+        """Store the FakeHttp to return."""
+        self.http = http
+
+    def Http(self, timeout=None):
+        """Return the FakeHttp."""
+        return self.http
+
+
+class FakeCredentials(object):
+    """Credentials that count refreshes."""
+
+    def __init__(self):
+        """Start with a stale token."""
+        self.token = 'stale'
+        self.refreshes = 0
+
+    def before_request(self, request, method, url, headers):
+        """Add the bearer token."""
+        headers['authorization'] = 'Bearer %s' % self.token
+
+    def refresh(self, request):
+        """Replace the token."""
+        self.refreshes += 1
+        self.token = 'fresh'
+
+
+class BuildHttpTest(unittest.TestCase):
+    """Test the authorized Http objects."""
+
+    def setUp(self):
+        """Serve a 401 and then a 200 from the transport."""
+        self.http = FakeHttp([401, 200])
+        self.httplib2 = ggbackup.httplib2
+        ggbackup.httplib2 = FakeHttplib2(self.http)
+        self.backup = GGBackup('example.com')
+        self.backup.credentials = FakeCredentials()
+
+    def tearDown(self):
+        """Restore httplib2."""
+        ggbackup.httplib2 = self.httplib2
+
+    def test_refreshes_token_after_401(self):
+        """A 401 refreshes the token and retries the request."""
+        resp, _ = self.backup.build_http().request('https://example.com/')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(self.backup.credentials.refreshes, 1)
+        self.assertEqual(self.http.headers[-1]['authorization'],
+                         'Bearer fresh')
+
+    def test_user_agent_has_gzip_once(self):
+        """(gzip) is added when missing and not repeated when present."""
+        self.http.statuses = [200, 200]
+        http = self.backup.build_http()
+        http.request('https://example.com/')
+        http.request('https://example.com/',
+                     headers={'user-agent': 'client/1 (gzip)'})
+        agents = [headers['user-agent'] for headers in self.http.headers]
+        self.assertTrue(re.match(r'ggbackup/\S+ \(gzip\)$', agents[0]))
+        self.assertTrue(re.match(r'ggbackup/\S+ client/1 \(gzip\)$',
+                                 agents[1]))
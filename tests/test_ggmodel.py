@@ -0,0 +1,59 @@
+# Copyright 2017 The Linde Group, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""FastJsonModel tests."""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+import unittest
+
+from apiclient.model import JsonModel
+
+from ggbackuplib import ggmodel
+from ggbackuplib.ggmodel import FastJsonModel
+
+BODIES = [
+    b'{"data": {"email": "a@example.com"}, "kind": "k"}',
+    b'{"email": "\\u00e9@example.com", "members": [{"id": "1"}]}',
+    b'[1, 2, 3]',
+]
+
+
+class FastJsonModelTest(unittest.TestCase):
+    """Test that FastJsonModel parses exactly like JsonModel."""
+
+    def assert_matches_json_model(self):
+        """Compare both models on bytes and str, with and without wrapper."""
+        for data_wrapper in (False, True):
+            fast = FastJsonModel(data_wrapper=data_wrapper)
+            stock = JsonModel(data_wrapper=data_wrapper)
+            for body in BODIES:
+                for content in (body, body.decode('utf-8')):
+                    self.assertEqual(fast.deserialize(content),
+                                     stock.deserialize(content))
+
+    @unittest.skipIf(ggmodel.orjson is None, 'orjson is not installed')
+    def test_orjson_matches_json_model(self):
+        """orjson parsing matches the stock model."""
+        self.assert_matches_json_model()
+
+    def test_fallback_matches_json_model(self):
+        """Without orjson the stock parser is used."""
+        orjson = ggmodel.orjson
+        ggmodel.orjson = None
+        try:
+            self.assert_matches_json_model()
+        finally:
+            ggmodel.orjson = orjson
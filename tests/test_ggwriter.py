@@ -0,0 +1,74 @@
+# Copyright 2017 The Linde Group, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""GGWriter tests."""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+from ggbackuplib import GGWriter
+
+MEMBER = {'kind': 'admin#directory#member', 'id': '1',
+          'email': 'user@example.com', 'role': 'MEMBER', 'type': 'USER',
+          'status': 'ACTIVE', 'etag': 'e'}
+
+
+class GGWriterTest(unittest.TestCase):
+    """Test writing group CSVs."""
+
+    def setUp(self):
+        """Create a scratch target directory."""
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the scratch target directory."""
+        shutil.rmtree(self.path)
+
+    def read_csv(self, filename):
+        """Return the rows of a CSV in the target directory."""
+        with open(os.path.join(self.path, filename)) as csvfile:
+            return list(csv.DictReader(csvfile))
+
+    def test_write_members_skips_groups_without_members(self):
+        """Groups whose members were not retrieved get no CSV."""
+        groups = {'a@example.com': {'email': 'a@example.com'},
+                  'b@example.com': {'email': 'b@example.com'}}
+        writer = GGWriter(self.path, groups,
+                          members={'a@example.com': [MEMBER]})
+        self.assertEqual(writer.write_members(), 1)
+
+        self.assertEqual(os.listdir(self.path),
+                         ['a@example.com-membership.csv'])
+        rows = self.read_csv('a@example.com-membership.csv')
+        self.assertEqual([row['email'] for row in rows], ['user@example.com'])
+
+    def test_members_default_to_group_records(self):
+        """Without members, lists are read from the groups themselves."""
+        groups = {'a@example.com': {'email': 'a@example.com',
+                                    'name': 'A',
+                                    'members': [MEMBER]}}
+        writer = GGWriter(self.path, groups, False)
+        self.assertEqual(writer.write_members(), 0)
+        writer.write_settings()
+
+        rows = self.read_csv('a@example.com-membership.csv')
+        self.assertEqual(len(rows), 1)
+        rows = self.read_csv('settings.csv')
+        self.assertEqual(rows, [{'email': 'a@example.com', 'name': 'A'}])